@@ -1,12 +1,29 @@
 import os
-from flask import Flask, render_template, request, send_file, jsonify
+import re
+import string
+from flask import Flask, render_template, request, send_file, jsonify, url_for
 from PIL import Image, ImageDraw, ImageFont
 import io
-import base64
-from datetime import datetime
+import functools
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
 
 app = Flask(__name__)
 
+# Characters found on standard plates; their glyphs and widths are built at startup
+PLATE_CHARS = string.ascii_uppercase + string.digits + ' -'
+
+# Normalized text accepted by the web endpoints (PLATE_CHARS only), which keeps the PNG cache keys bounded
+PLATE_TEXT_RE = re.compile(f'[{re.escape(PLATE_CHARS)}]+')
+
+# Encoded plates kept per process; at roughly 95 KB each this caps the cache near 25 MB
+PNG_CACHE_SIZE = 256
+
+# Clean working copies of each base image kept for reuse between renders
+SCRATCH_POOL_SIZE = 4
+
 class OregonPlateGenerator:
     def __init__(self):
         # Define plate configurations
@@ -22,12 +39,36 @@ class OregonPlateGenerator:
             }
         }
         
+        # Try different font paths for different systems
+        self.font_paths = [
+            "C:/Windows/Fonts/arial.ttf",  # Windows
+            "/System/Library/Fonts/Arial.ttf",  # macOS
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",  # Linux
+            "arial.ttf"  # Local
+        ]
+        # Loaded fonts keyed by (font paths, size)
+        self._fonts = {}
+        # Rendered glyph masks keyed by (font, character)
+        self._glyph_cache = {}
+        # Pooled working copies of the base images keyed by plate type, see render_png
+        self._scratch_images = {}
+        self._scratch_lock = threading.Lock()
+        
         # Create directories if they don't exist
         os.makedirs('static/images', exist_ok=True)
         os.makedirs('static/output', exist_ok=True)
         
-        # Process the uploaded image to create clean base
-        self.create_clean_base_image()
+        # Decode each base image once so requests only need to copy pixels,
+        # creating a placeholder in memory if the clean image doesn't exist
+        self._base_images = {}
+        for plate_type, config in self.plate_config.items():
+            config['text_color_rgb'] = self.hex_to_rgb(config['text_color'])
+            self._base_images[plate_type] = self.load_base_image(config['image_path'])
+            font = self._get_font(config['font_size'])
+            
+            # Pre-render the glyphs and widths most plates are made of
+            for char in PLATE_CHARS:
+                self._get_glyph(font, char)
     
     def create_clean_base_image(self):
         """
@@ -42,15 +83,10 @@ class OregonPlateGenerator:
         
         # For demonstration, we'll create a template
         # You would replace this with the actual cleaned image
-        try:
-            # Try to load existing clean image
-            base_img = Image.open('static/images/oregon_standard_clean.png')
-        except FileNotFoundError:
-            # Create a placeholder if the clean image doesn't exist
-            self.create_placeholder_image()
+        return self.load_base_image(self.plate_config['standard']['image_path'])
     
     def create_placeholder_image(self):
-        """Create a placeholder Oregon plate image"""
+        """Create, save and return a placeholder Oregon plate image"""
         # Create base image with Oregon plate dimensions (roughly 12" x 6")
         width, height = 950, 475
         img = Image.new('RGB', (width, height), '#E8F4F8')  # Light blue background
@@ -79,10 +115,7 @@ class OregonPlateGenerator:
             draw.ellipse([tree_x-size, y_offset-size//2, tree_x+size, y_offset+size//2], fill='#5C8A58')
         
         # Add "Oregon" text at top
-        try:
-            font = ImageFont.truetype("arialbold.ttf", 48) # original = arial.tff
-        except:
-            font = ImageFont.load_default()
+        font = self._get_font(48, ["arialbold.ttf"]) # original = arial.tff
         
         text = "Oregon"
         bbox = draw.textbbox((0, 0), text, font=font)
@@ -100,101 +133,203 @@ class OregonPlateGenerator:
         
         # Save the placeholder
         img.save('static/images/oregon_standard_clean.png')
+        return img
+    
+    def load_base_image(self, image_path):
+        """Open a base plate image and fully decode it into memory"""
+        try:
+            base_img = Image.open(image_path)
+        except FileNotFoundError:
+            # The placeholder is already in memory, no need to read it back
+            return self.create_placeholder_image()
+        
+        # Force the PNG to decode now rather than lazily on first use
+        base_img.load()
+        return base_img
+    
+    def _get_font(self, size, font_paths=None):
+        """Return a cached font for the given size, loading it on first use"""
+        key = (tuple(font_paths or self.font_paths), size)
+        if key not in self._fonts:
+            self._fonts[key] = self._load_font(key[0], size)
+        return self._fonts[key]
+    
+    def _load_font(self, font_paths, size):
+        """Load the first available TrueType font, falling back to the default"""
+        for path in font_paths:
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                continue
+        return ImageFont.load_default()
+    
+    def _get_glyph(self, font, char):
+        """Return a cached (mask, offset, width) for a character, rendering it on first use"""
+        key = (font, char)
+        if key not in self._glyph_cache:
+            left, top, right, bottom = font.getbbox(char)
+            
+            # Rasterize the glyph once into a grayscale mask trimmed to its bounding box
+            mask = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+            self._glyph_cache[key] = (mask, (left, top), right - left)
+        return self._glyph_cache[key]
     
     def hex_to_rgb(self, hex_color):
         """Convert hex color to RGB tuple"""
-        hex_color = hex_color.lstrip('#')
-        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+        return tuple(bytes.fromhex(hex_color.lstrip('#')))
     
-    def generate_plate(self, text, plate_type='standard'):
-        """Generate license plate with custom text"""
+    def normalize_text(self, text, plate_type='standard'):
+        """Uppercase, strip and truncate text to fit the plate type"""
         if plate_type not in self.plate_config:
             raise ValueError(f"Unknown plate type: {plate_type}")
         
-        config = self.plate_config[plate_type]
+        return text.upper().strip()[:self.plate_config[plate_type]['max_chars']]
+    
+    def generate_plate(self, text, plate_type='standard'):
+        """Generate license plate with custom text"""
+        # Create a copy of the cached base image to work with
+        img = self._get_base_image(plate_type).copy()
+        self.draw_plate_text(img, text, plate_type)
+        return img
+    
+    def render_png(self, text, plate_type='standard'):
+        """Generate a license plate and return it encoded as PNG bytes"""
+        # Draw onto a pooled scratch copy instead of copying the whole base image
+        img = self._acquire_scratch_image(plate_type)
+        box = self.draw_plate_text(img, text, plate_type)
+        
+        # Save to bytes, favouring encode speed over a few KB of PNG size
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='PNG', compress_level=1)
         
+        # Restore only the pixels the text touched, then hand the copy back
+        img.paste(self._get_base_image(plate_type).crop(box), box[:2])
+        self._release_scratch_image(plate_type, img)
+        return img_bytes.getvalue()
+    
+    def _get_base_image(self, plate_type):
+        """Return the cached base image for a plate type"""
+        if plate_type not in self._base_images:
+            raise ValueError(f"Unknown plate type: {plate_type}")
+        return self._base_images[plate_type]
+    
+    def _acquire_scratch_image(self, plate_type):
+        """Take a clean working copy of a base image from the pool, copying the base if it is empty"""
+        base_img = self._get_base_image(plate_type)
+        with self._scratch_lock:
+            pool = self._scratch_images.setdefault(plate_type, [])
+            if pool:
+                return pool.pop()
+        return base_img.copy()
+    
+    def _release_scratch_image(self, plate_type, img):
+        """Return a restored working copy to the pool, dropping it if the pool is full"""
+        with self._scratch_lock:
+            pool = self._scratch_images.setdefault(plate_type, [])
+            if len(pool) < SCRATCH_POOL_SIZE:
+                pool.append(img)
+    
+    def draw_plate_text(self, img, text, plate_type='standard'):
+        """Draw license text onto a base image and return the bounding box it covers"""
         # Validate text
-        text = text.upper().strip()
-        if len(text) > config['max_chars']:
-            text = text[:config['max_chars']]
+        text = self.normalize_text(text, plate_type)
+        config = self.plate_config[plate_type]
         
-        # Load base image
-        try:
-            base_img = Image.open(config['image_path'])
-        except FileNotFoundError:
-            self.create_placeholder_image()
-            base_img = Image.open(config['image_path'])
+        font = self._get_font(config['font_size'])
+        
+        # Calculate text position with letter spacing
+        if config.get('letter_spacing', 0) > 0:
+            return self.draw_text_with_spacing(img, text, config['text_position'], 
+                                               font, config['text_color_rgb'], config['letter_spacing'])
         
-        # Create a copy to work with
-        img = base_img.copy()
         draw = ImageDraw.Draw(img)
         
-        # Load font
-        try:
-            # Try different font paths for different systems
-            font_paths = [
-                "C:/Windows/Fonts/arial.ttf",  # Windows
-                "/System/Library/Fonts/Arial.ttf",  # macOS
-                "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",  # Linux
-                "arial.ttf"  # Local
-            ]
-            font = None
-            for path in font_paths:
-                try:
-                    font = ImageFont.truetype(path, config['font_size'])
-                    break
-                except:
-                    continue
-            
-            if font is None:
-                font = ImageFont.load_default()
-        except:
-            font = ImageFont.load_default()
+        # Get text bounding box for centering
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
         
-        # Calculate text position with letter spacing
-        if config.get('letter_spacing', 0) > 0:
-            self.draw_text_with_spacing(draw, text, config['text_position'], 
-                                      font, config['text_color'], config['letter_spacing'])
-        else:
-            # Get text bounding box for centering
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            
-            # Center the text
-            x = config['text_position'][0] - text_width // 2
-            y = config['text_position'][1] - text_height // 2
-            
-            draw.text((x, y), text, fill=self.hex_to_rgb(config['text_color']), font=font)
+        # Center the text
+        x = config['text_position'][0] - text_width // 2
+        y = config['text_position'][1] - text_height // 2
         
-        return img
+        draw.text((x, y), text, fill=config['text_color_rgb'], font=font)
+        
+        # Reuse the centering bbox rather than laying the text out again
+        return (x + bbox[0], y + bbox[1], x + bbox[2], y + bbox[3])
     
-    def draw_text_with_spacing(self, draw, text, position, font, color, spacing):
-        """Draw text with custom letter spacing"""
+    def draw_text_with_spacing(self, img, text, position, font, color, spacing):
+        """Draw text with custom letter spacing using cached glyph masks"""
         x, y = position
-        color_rgb = self.hex_to_rgb(color)
+        y -= 25  # Adjust y for vertical centering
+        glyphs = [self._get_glyph(font, char) for char in text]
         
         # Calculate total width to center the text
-        total_width = 0
-        char_widths = []
-        for char in text:
-            bbox = draw.textbbox((0, 0), char, font=font)
-            char_width = bbox[2] - bbox[0]
-            char_widths.append(char_width)
-            total_width += char_width
-        
+        total_width = sum(width for _, _, width in glyphs)
         total_width += spacing * (len(text) - 1)
         
         # Start from center position minus half total width
         current_x = x - total_width // 2
+        box = [current_x, y, current_x, y]
         
-        for i, char in enumerate(text):
-            draw.text((current_x, y - 25), char, fill=color_rgb, font=font)  # Adjust y for vertical centering
-            current_x += char_widths[i] + spacing
+        for mask, (left, top), width in glyphs:
+            glyph_x, glyph_y = current_x + left, y + top
+            img.paste(color, (glyph_x, glyph_y), mask)
+            
+            # Grow the bounding box to cover this glyph
+            box[0] = min(box[0], glyph_x)
+            box[1] = min(box[1], glyph_y)
+            box[2] = max(box[2], glyph_x + mask.width)
+            box[3] = max(box[3], glyph_y + mask.height)
+            current_x += width + spacing
+        
+        return tuple(box)
 
 # Initialize the plate generator
 plate_generator = OregonPlateGenerator()
 
+@functools.lru_cache(maxsize=PNG_CACHE_SIZE)
+def _render_png_bytes(text, plate_type):
+    """Render a plate and encode it as PNG, cached per normalized text"""
+    return plate_generator.render_png(text, plate_type)
+
+# Plates only change when the app restarts, so this doubles as their Last-Modified time
+STARTED_AT = datetime.now(timezone.utc)
+
+# Renders currently in progress, keyed like the PNG cache
+_pending_renders = {}
+_pending_renders_lock = threading.Lock()
+
+def validate_plate_text(text, plate_type='standard'):
+    """Normalize plate text and reject anything the web endpoints won't render"""
+    text = plate_generator.normalize_text(text, plate_type)
+    if not PLATE_TEXT_RE.fullmatch(text):
+        raise ValueError("Plate text must be non-empty and use only letters, numbers, spaces and hyphens")
+    return text
+
+def render_png_bytes(text, plate_type='standard'):
+    """Return the encoded PNG for a plate, reusing earlier renders of the same text"""
+    key = (validate_plate_text(text, plate_type), plate_type)
+    
+    # Concurrent requests for the same plate wait on a single render
+    with _pending_renders_lock:
+        future = _pending_renders.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _pending_renders[key] = Future()
+    
+    if is_owner:
+        try:
+            future.set_result(_render_png_bytes(*key))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with _pending_renders_lock:
+                del _pending_renders[key]
+    
+    return future.result()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -206,40 +341,48 @@ def generate_plate():
         text = data.get('text', 'SAMPLE')
         plate_type = data.get('plate_type', 'standard')
         
-        # Generate the plate
-        img = plate_generator.generate_plate(text, plate_type)
-        
-        # Save to bytes
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG', quality=95)
-        img_bytes.seek(0)
-        
-        # Convert to base64 for web display
-        img_base64 = base64.b64encode(img_bytes.getvalue()).decode()
+        # Let the browser fetch the PNG directly rather than inlining it as base64;
+        # the plate is rendered once, when that request arrives
+        image_url = url_for('plate_image', plate_type=plate_type,
+                            text=validate_plate_text(text, plate_type))
         
         return jsonify({
             'success': True,
-            'image': f'data:image/png;base64,{img_base64}',
-            'filename': f'oregon_plate_{text}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png'
+            'url': image_url,
+            'filename': f'oregon_plate_{text}_{time.strftime("%Y%m%d_%H%M%S")}.png'
         })
     
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/plates/<plate_type>.png')
+def plate_image(plate_type):
+    try:
+        img_bytes = io.BytesIO(render_png_bytes(request.args.get('text', ''), plate_type))
+        
+        return send_file(img_bytes, mimetype='image/png',
+                         conditional=True, last_modified=STARTED_AT)
+    
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
 @app.route('/download/<text>')
 def download_plate(text):
     try:
-        img = plate_generator.generate_plate(text)
-        
-        # Save to bytes
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG', quality=95)
-        img_bytes.seek(0)
+        img_bytes = io.BytesIO(render_png_bytes(text))
         
         return send_file(img_bytes, 
                         mimetype='image/png',
                         as_attachment=True,
-                        download_name=f'oregon_plate_{text}.png')
+                        download_name=f'oregon_plate_{text}.png',
+                        conditional=True,
+                        last_modified=STARTED_AT)
+    
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     except Exception as e:
         return jsonify({'error': str(e)})
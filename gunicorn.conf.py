@@ -0,0 +1,12 @@
+import multiprocessing
+
+bind = '0.0.0.0:5000'
+
+# One worker per core, each with a couple of threads for overlapping I/O.
+# Every worker fills its own PNG cache after fork, see PNG_CACHE_SIZE in app.py
+workers = multiprocessing.cpu_count()
+threads = 2
+
+# Import app.py once in the master so forked workers share the decoded base
+# images, fonts and glyph masks copy-on-write instead of each rebuilding them
+preload_app = True